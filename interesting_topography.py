@@ -19,84 +19,120 @@ each of the grid squares. The important one of these is the .asc file
 from PIL import Image
 import zipfile
 import os
-from shutil import rmtree
+import io
+import mmap
+import tempfile
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
 from math import floor
 import numpy as np
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # Numba is optional - without it the kernels run as plain Python
+    HAVE_NUMBA = False
+    prange = range
 
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# Combined arrays larger than this (in bytes) are memory-mapped to a
+# temporary file, so the OS can page them out instead of holding it all in RAM
+MEMMAP_THRESHOLD = 1024 ** 3
+
+
+@dataclass(slots=True, frozen=True)
 class HeightCell:
     """
     A single cell of the height map from Ordnance Survey's site
+    Fields are in the same order as the .asc header, followed by the heights
     """
-    def __init__(self, dimensions, heights, exclude=[]):
-        """
-        Initialise this HeightCell with the properties passed to it
-        dimensions is (cols, rows, xcorner, ycorner, cellsize)
-        """
-        cols, rows, xcorner, ycorner, cellsize = dimensions
-
-        self.xsize = cols
-        self.ysize = rows
-        self.xcorner = xcorner  # Lower left corner
-        self.ycorner = ycorner  # Lower left corner
-        self.size = cellsize
-        self.heights = heights
-        self.exclude = exclude
-
-        valid_values = list(filter(lambda x: x is not None, self.flattened))
-        self.max = max(valid_values)
-        self.min = min(valid_values)
-
-
-    @property
-    def flattened(self):
-        """
-        Return a flattened list of the heights in the cell
-        Yes, I'm aware of the irony in the name
-        """
-        flat = [item for sublist in self.heights for item in sublist]
-        return [h if h not in self.exclude else None for h in flat]
+    xsize: int
+    ysize: int
+    xcorner: int    # Lower left corner
+    ycorner: int    # Lower left corner
+    size: int
+    heights: np.ndarray
 
 
-def importAsc(asc_file_name):
+def parseAsc(asc_data):
     """
-    Import a .asc file from Ordnance Survey as a HeightCell
+    Parse the contents of a .asc file from Ordnance Survey as a HeightCell
+    asc_data can be bytes or any buffer supporting find and slicing
     """
 
-    with open(asc_file_name, "r") as asc_file:
-        lines = asc_file.readlines()
-
     # First 5 lines are dimensions
-    dimensions = (int(l.split(" ")[-1]) for l in lines[:5])
+    header_end = 0
+    for _ in range(5):
+        header_end = asc_data.find(b"\n", header_end) + 1
 
-    # Lines after this are the height data
-    heights = [list(map(float, l.rstrip().split(" "))) for l in lines[5:]]
+    header = asc_data[:header_end].decode("ascii").splitlines()
+    dimensions = (int(l.split()[-1]) for l in header)
 
-    # Some values may need to be excluded
-    exclude = []
+    # Lines after this are the height data
+    heights = np.loadtxt(io.BytesIO(asc_data[header_end:]),
+                         dtype=np.float32, ndmin=2)
 
-    height_cell = HeightCell(dimensions, heights, exclude)
+    height_cell = HeightCell(*dimensions, heights)
 
     return height_cell
 
 
-def saveCellAsImage(cell, image_name):
+def importAsc(asc_file_name):
+    """
+    Import a .asc file from Ordnance Survey as a HeightCell
+    The file is memory-mapped rather than read through Python line by line
+    """
+
+    with open(asc_file_name, "rb") as asc_file:
+        with mmap.mmap(asc_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as asc_data:
+            return parseAsc(asc_data)
+
+
+def importAscsFromZip(zip_path):
+    """
+    Import every .asc file in the zip file at zip_path as HeightCells
+    The zip file is only opened once, and nothing is extracted to disk
+    """
+
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        return [parseAsc(zip_ref.read(info))
+                for info in zip_ref.infolist()
+                if info.filename.endswith(".asc")]
+
+
+def saveCellAsImage(cell, image_name, exclude=[]):
     """
     Save a HeightCell's height data to an image
     cell should be a valid HeightCell instance
+    Heights in exclude are ignored when scaling
     """
 
-    def scaleBetween(x, in_min, in_max, out_min, out_max):
-        return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
+    heights = cell.heights
+
+    # Build a mask of excluded values once and reduce over the rest
+    is_excluded = None
+    valid_heights = heights
+    if len(exclude) > 0:
+        excluded = np.asarray(exclude, dtype=heights.dtype)
+        is_excluded = np.isin(heights, excluded)
+        valid_heights = heights[~is_excluded]
+
+    min_height = float(np.minimum.reduce(valid_heights, axis=None))
+    max_height = float(np.maximum.reduce(valid_heights, axis=None))
 
     # Scale point data so it goes 0-255
     # Excluded values are set to 0 (black)
-    scaleTo255 = lambda x: scaleBetween(x, cell.min, cell.max, 0, 255) if x is not None else 0
-    scaled_pixels = list(map(scaleTo255, cell.flattened))
+    scale = 255.0 / (max_height - min_height)
+    scaled_pixels = (heights - min_height) * scale
+    if is_excluded is not None:
+        scaled_pixels[is_excluded] = 0
 
     # Save image
-    img = Image.new("L", (cell.xsize, cell.ysize))
-    img.putdata(scaled_pixels)
+    img = Image.fromarray(scaled_pixels.astype(np.uint8), mode="L")
     img.save(image_name)
 
 
@@ -116,67 +152,57 @@ def chooseSquare(base_dir):
 
     square_names = square_name.lower().split(" ")
 
+    valid_square_set = set(valid_square_names)
     for name in square_names:
-        if name not in valid_square_names:
+        if name not in valid_square_set:
             raise ValueError("\"{}\" not a valid square name".format(name))
 
     return square_names
 
 
-def extractAscsFromSquare(base_dir, tmp_dir, square_name):
+def findZipsInSquare(base_dir, square_name):
     """
-    Extract all .asc files from the .zip files in the chosen square
-    The files are extracted into tmp_dir
+    Find all .zip files in the chosen square
+    Each of these contains the .asc file for one cell
 
-    Returns list of the file names
+    Returns sorted list of the zip file paths
     """
     square_base_dir = os.path.join(base_dir, square_name)
 
-    # Find out if this square is already extracted
-    imported_asc_files = sorted(os.listdir(tmp_dir))
-    is_selected_square = (f[:2].lower() == square_name for f in imported_asc_files)
-    already_extracted = any(is_selected_square)
-
-    # No need to extract any files - just return this square's ones
-    if already_extracted:
-        return filter(lambda f: f[:2].lower() == square_name,
-                      imported_asc_files)
+    return [os.path.join(square_base_dir, item)
+            for item in sorted(os.listdir(square_base_dir))
+            if item.endswith(".zip")]
 
-    # Otherwise get the files from the zip file
-    file_names = []
 
-    for item in os.listdir(square_base_dir):
-        if not item.endswith(".zip"):
-            continue    # Skip non-zip files
+def extractCellDataFromZips(zip_list):
+    """
+    Import the cell data for all .asc files in the zip files in zip_list
+    Zip files are parsed in parallel across worker processes
 
-        item_path = os.path.join(square_base_dir, item)
+    Returns (corners, cell_heights):
+        corners      = (N, 2) array of each cell's (xcorner, ycorner)
+        cell_heights = (N, rows, cols) array of each cell's heights
+    """
 
-        with zipfile.ZipFile(item_path, "r") as zip_ref:
-            contents = zip_ref.namelist()
-            asc_files = filter(lambda f: f.endswith(".asc"), contents)
+    with ProcessPoolExecutor() as executor:
+        zip_cells = executor.map(importAscsFromZip, zip_list, chunksize=8)
+        cells = [cell for cells in zip_cells for cell in cells]
 
-            for asc_file in asc_files:
-                zip_ref.extract(asc_file, tmp_dir)
-                file_names.append(asc_file)
+    corners = np.array([(c.xcorner, c.ycorner) for c in cells],
+                       dtype=np.int64)
+    cell_heights = np.stack([c.heights for c in cells])
 
-    return sorted(file_names)
+    return corners, cell_heights
 
 
-def extractCellDataFromAscs(map_data_dir, asc_list):
-    """
-    Return HeightCell instances for all .asc files in asc_list
-    The asc files should be in map_data_dir already
-    """
-
-    return [importAsc(os.path.join(map_data_dir, a)) for a in asc_list]
-
-
-def getDimensions(height_cells):
+def getDimensions(corners):
     """
     Get dimensions needed for scaling
+    corners is an (N, 2) array of each cell's (xcorner, ycorner)
     Return dict:
         cell_size   = Cell size in metres
         cell_side   = Number of measurements (pixels) along one side of a cell
+        measurement_interval = Distance between measurements in metres
         cell_rows   = Number of rows of cells in the image
         img_width   = Width in pixels of the output image
         img_height  = Height in pixels of the output image
@@ -190,12 +216,12 @@ def getDimensions(height_cells):
     cell_res = cell_side ** 2
 
     # Get image dimensions from real-life size
-    x_corners = [c.xcorner for c in height_cells]
-    y_corners = [c.ycorner for c in height_cells]
-    max_x = max(x_corners) + cell_size
-    max_y = max(y_corners) + cell_size
-    min_x = min(x_corners)
-    min_y = min(y_corners)
+    x_corners = corners[:, 0]
+    y_corners = corners[:, 1]
+    max_x = int(x_corners.max()) + cell_size
+    max_y = int(y_corners.max()) + cell_size
+    min_x = int(x_corners.min())
+    min_y = int(y_corners.min())
 
     ground_width = (max_x - min_x)
     ground_height = (max_y - min_y)
@@ -206,6 +232,7 @@ def getDimensions(height_cells):
 
     return {"cell_size": cell_size,
             "cell_side": cell_side,
+            "measurement_interval": measurement_interval,
             "cell_rows": cell_rows,
             "img_width": img_width,
             "img_height": img_height,
@@ -214,52 +241,99 @@ def getDimensions(height_cells):
             "max_y": max_y}
 
 
+@njit(parallel=True, cache=True, fastmath=True)
+def scaleToUint8(heights, low, high):
+    """
+    Scale heights from low-high to 0-255 in a single pass
+    Values outside the range are clamped
+    """
+    scaled = np.empty(heights.shape, dtype=np.uint8)
+    scale = 255.0 / (high - low)
+
+    for i in prange(heights.shape[0]):
+        for j in range(heights.shape[1]):
+            v = (heights[i, j] - low) * scale
+            if v < 0:
+                scaled[i, j] = 0
+            elif v > 255:
+                scaled[i, j] = 255
+            else:
+                scaled[i, j] = np.uint8(v)
+
+    return scaled
+
+
 def scaleHeightData(heights):
     """
     Scale height data from its current range to 0-255 for image output
+    Returns a uint8 array ready to be turned into an image
     """
 
     min_height = heights.min()
+    max_height = heights.max()
+
+    # Sea is 0, so only shift the range if there are negative values
+    if HAVE_NUMBA:
+        return scaleToUint8(heights, min(min_height, 0), max_height)
 
     # Shift any negative values up
     if min_height < 0:
-        heights -= min_height
+        np.subtract(heights, min_height, out=heights)
+        max_height -= min_height
 
-    # Scale heights to 255
-    heights *= 255.0 / heights.max()
-    return heights
+    # Scale heights to 255, writing straight into the uint8 output
+    scaled = np.empty(heights.shape, dtype=np.uint8)
+    np.multiply(heights, np.float32(255.0 / max_height), out=scaled,
+                casting="unsafe")
+    return scaled
 
 
-def combineCells(height_cells):
+@njit(parallel=True, cache=True)
+def placeCells(heights_combined, cell_heights, start_xs, start_ys, side):
     """
-    Combine all height cells into one array and return it
+    Copy each cell's heights into heights_combined
+    cell_heights is a stacked (N, side, side) array of the cells' heights
+    start_xs and start_ys are the pixel positions of each cell's top left
     """
+    for i in prange(len(start_xs)):
+        x = start_xs[i]
+        y = start_ys[i]
+        heights_combined[y:y + side, x:x + side] = cell_heights[i]
 
-    dims = getDimensions(height_cells)
-
-    # Use zero for default height (sea)
-    heights_combined = np.zeros((dims["img_height"], dims["img_width"]))
 
-    for cell in height_cells:
-        # Get the start x and y indices of the cell
-        cell_col = (cell.xcorner - dims["min_x"]) / dims["cell_size"]
-        cell_row = (dims["max_y"] - cell.ycorner) / dims["cell_size"] - 1
-        cell_start_x = int(cell_col * dims["cell_side"])
-        cell_start_y = int(cell_row * dims["cell_side"])
+def combineCells(corners, cell_heights):
+    """
+    Combine all height cells into one array and return it
+    Takes the (corners, cell_heights) arrays from extractCellDataFromZips
+    """
 
-        # Add actual height data to heights_combined
-        for row, row_data in enumerate(cell.heights):
-            for col, h in enumerate(row_data):
-                # Get the pixel locations of this pixel
-                px_col = cell_start_x + col
-                px_row = cell_start_y + row
+    dims = getDimensions(corners)
 
-                heights_combined[px_row][px_col] = h
+    # Use zero for default height (sea)
+    shape = (dims["img_height"], dims["img_width"])
+    if np.prod(shape) * np.dtype(np.float32).itemsize > MEMMAP_THRESHOLD:
+        # A new memmap is zero-filled, and the file is deleted once closed
+        heights_combined = np.asarray(np.memmap(
+            tempfile.TemporaryFile(), dtype=np.float32, mode="w+",
+            shape=shape))
+    else:
+        heights_combined = np.zeros(shape, dtype=np.float32)
+
+    # Get the start x and y indices of every cell at once
+    x_corners = corners[:, 0]
+    y_corners = corners[:, 1]
+    interval = dims["measurement_interval"]
+    cell_side = int(dims["cell_side"])
+    start_xs = (x_corners - dims["min_x"]) // interval
+    start_ys = (dims["max_y"] - y_corners) // interval - cell_side
+
+    # Add actual height data to heights_combined
+    placeCells(heights_combined, cell_heights, start_xs, start_ys, cell_side)
 
     return heights_combined
 
 
-def makeImage(base_dir, map_data_dir, image_name, square_names, verbose=False):
+def makeImage(base_dir, image_name, square_names, verbose=False):
     """
     Generate an image from the chosen square
     """
@@ -267,20 +341,19 @@ def makeImage(base_dir, map_data_dir, image_name, square_names, verbose=False):
     if verbose:
         print("Importing map squares from .asc files")
 
-    asc_files = []
+    zip_files = []
     for square in square_names:
-        # Add all .asc files from this square
-        asc_files.extend(
-            extractAscsFromSquare(base_dir, map_data_dir, square))
+        # Add all .zip files from this square
+        zip_files.extend(findZipsInSquare(base_dir, square))
 
-    # Import the cells as HeightCell objects
-    height_cells = extractCellDataFromAscs(map_data_dir, asc_files)
+    # Import the cells' corners and heights
+    corners, cell_heights = extractCellDataFromZips(zip_files)
 
     if verbose:
         print("Merging cells into one array")
 
-    # Merge all HeightCells into one array
-    heights = combineCells(height_cells)
+    # Merge all cells into one array
+    heights = combineCells(corners, cell_heights)
 
     if verbose:
         print("Scaling to useful pixel brightness range")
@@ -296,18 +369,14 @@ def makeImage(base_dir, map_data_dir, image_name, square_names, verbose=False):
         image_name += ".png"
 
     # Save image
-    img = Image.new("L", heights.shape[::-1])
-    img.putdata(heights.flatten())
+    img = Image.fromarray(heights, mode="L")
     img.save(image_name)
 
-    # Remove map_data_dir so files aren't included in the next iteration
-    #rmtree(map_data_dir)
-
     if verbose:
         print("Done!")
 
 
-def interactiveMakeImage(base_dir, map_data_dir, image_name, verbose):
+def interactiveMakeImage(base_dir, image_name, verbose):
     """
     Interactively select grid squares and generate an image
     """
@@ -320,12 +389,11 @@ def interactiveMakeImage(base_dir, map_data_dir, image_name, verbose):
     if image_name_new != "":
         image_name = image_name_new
 
-    makeImage(base_dir, map_data_dir, image_name, square_names, verbose)
+    makeImage(base_dir, image_name, square_names, verbose)
 
 
 if __name__ == "__main__":
     base_dir = os.path.join(".", "OS - terr50_gagg_gb", "data")
-    map_data_dir = os.path.join(".", "map_data")
     image_name = "image"
 
-    interactiveMakeImage(base_dir, map_data_dir, image_name, verbose=True)
+    interactiveMakeImage(base_dir, image_name, verbose=True)